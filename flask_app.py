@@ -1,6 +1,7 @@
-from flask import Flask, Response, request
+from quart import Quart, Response, request
 from transaction_logic import transaction_logic, db
-import json
+import orjson
+import uvicorn
 
 """
 This file contains the application and API code used to run the web service for
@@ -8,23 +9,66 @@ this assignment. It can be run from the command line:
 
     python3 flask_app.py
 
-Nothing else is required. The Flask framework handles all requests. Flask's 
+or served directly by an ASGI server, e.g.
+
+    uvicorn flask_app:app --host 0.0.0.0 --port 3000 --workers 1 --loop uvloop
+
+For a production deployment the same app can be run under Gunicorn's process
+manager with Uvicorn workers:
+
+    gunicorn -w 1 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:3000 flask_app:app
+
+Each worker process holds its own in-memory copy of the transaction list, so
+the worker count must stay at 1 until transactions are kept in a store shared
+between processes; raising -w would give every worker different balances.
+
+Nothing else is required. The Quart framework (an async reimplementation of
+the Flask API) handles all requests on an asyncio event loop. Quart's 
 decorators (beginning with @ above the function definitions) indicate the
 API endpoints and the request methods they allow. This file covers only the
 API; see transaction_logic.py for business logic.
 """
 
-# Instantiates a flask app, does nothing else
+# Instantiates a quart app, does nothing else
 def create_app():
-    app = Flask(__name__)
+    app = Quart(__name__)
     return app
 
-# instantiates this class so Flask endpoints can access its methods
+# instantiates this class so Quart endpoints can access its methods
 app = create_app()
 
+# Body of a successful /add response; it never changes, so it is encoded once
+_EMPTY_JSON = b"{}"
+
+# /balances bodies for fewer payers than this are serialized in one go;
+# streaming only pays off once the payload is large
+_BALANCES_STREAM_THRESHOLD = 10000
+# Number of payers serialized into each chunk of a streamed /balances body
+_BALANCES_CHUNK_SIZE = 1000
+
+async def _stream_balances(balances):
+    """
+    Yields the JSON encoding of a payer -> points dict a chunk at a time, so
+    the response body for a large number of payers is never built as a single
+    string. Payers are grouped into chunks of _BALANCES_CHUNK_SIZE rather
+    than sent one at a time to avoid a separate write per payer. This is an
+    async generator so Quart iterates it on the event loop; a plain generator
+    would have every chunk fetched through the thread pool.
+    """
+    chunk = [ b"{" ]
+    sep = b""
+    for payer, points in balances.items():
+        chunk.append(sep + orjson.dumps(payer) + b":" + str(points).encode())
+        sep = b","
+        if len(chunk) >= _BALANCES_CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk = []
+    chunk.append(b"}")
+    yield b"".join(chunk)
+
 # Add transactions for a specific payer and date
 @app.route("/add", methods = ['POST'] )
-def add():
+async def add():
     """
     POST only - this modifies the stored transaction list in a non-idempotent
     way.
@@ -41,23 +85,23 @@ def add():
     """
 
     try:
-        data = request.get_json( force = True )
+        data = orjson.loads(await request.get_data())
         db.add_points(data)
         return Response(
-            json.dumps({}) ,
+            _EMPTY_JSON ,
             status = 200 ,
             mimetype='application/json' ,
         )
     except ValueError as e:
         return Response(
-                    json.dumps({ "error": str(e) }) ,
+                    orjson.dumps({ "error": str(e) }) ,
                     status = 400 ,
                     mimetype='application/json' ,
         )
 
 # Return all payer point balances
 @app.route("/balances", methods = ['GET'])
-def balances():
+async def balances():
     """
     GET only - this returns stored information but cannot modify it
 
@@ -65,13 +109,24 @@ def balances():
     list and their current point totals as ints.
 
     Any request body is ignored.
+
+    When there are at least _BALANCES_STREAM_THRESHOLD payers the body is
+    streamed in chunks as it is serialized, so clients can start parsing
+    before the whole object has been produced; smaller bodies are serialized
+    in one go. Either way it is built from a snapshot of the balances, so
+    transactions committed while it is being sent do not affect it.
     
     Response code is 200 unless the attempt to access the transaction list
     fails somehow, and 500 in that case.
     """
     try:
+        balances = db.payer_balances()
+        if len(balances) < _BALANCES_STREAM_THRESHOLD:
+            body = orjson.dumps(balances)
+        else:
+            body = _stream_balances(balances)
         return Response(
-            json.dumps(db.payer_balances()) ,
+            body ,
             status = 200 ,
             mimetype='application/json'
         )
@@ -79,13 +134,13 @@ def balances():
         # Hard to imagine when this would ever be needed, but *something* has
         # to be returned
         return Response(
-            { "error": "Something went wrong" } ,
+            orjson.dumps({ "error": "Something went wrong" }) ,
             status = 500 ,
             mimetype='application/json'
         )
 
 @app.route("/spend", methods = ['POST'])
-def spend():
+async def spend():
     """
     POST only - this modifies the stored transaction list in a non-idempotent
     way.
@@ -103,20 +158,21 @@ def spend():
     operation succeeded, and 400 with an error message otherwise.
     """
     try:
-        amount = request.get_json( force = True )
+        amount = orjson.loads(await request.get_data())
         return Response(
-            json.dumps(db.spend_points(amount["points"])) ,
+            orjson.dumps(db.spend_points(amount["points"])) ,
             status = 200 ,
             mimetype='application/json'
         )
     except ValueError as e:
         return Response(
-            json.dumps({ "error" : str(e) }) ,
+            orjson.dumps({ "error" : str(e) }) ,
             status = 400 ,
             mimetype='application/json'
         )
 
 
-if __name__ != 'main':
-    # Allows the running of the app from the command line
-    app.run(host="localhost", port=3000, debug=True)
+if __name__ == '__main__':
+    # Allows the running of the app from the command line ("auto" uses
+    # uvloop when it is installed and the stdlib asyncio loop otherwise)
+    uvicorn.run(app, host="localhost", port=3000, loop="auto")
@@ -4,8 +4,42 @@
 # Using a JSON data store because I already know how to work with that and
 # Flask makes in-memory storage more difficult
 from distutils.log import error
-import json, os
+import bisect, json, os, re, sys
+from array import array
+from collections import defaultdict
 from datetime import datetime
+from operator import itemgetter
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it _consume() runs as ordinary Python
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+@njit(cache = True)
+def _consume(remaining, amount):
+    """
+    Spends amount from remaining (an array of unspent points per credit,
+    oldest first) in place, oldest points first. Returns the index of the
+    oldest credit that still has unspent points. Kept free of Python objects
+    so numba can compile it to a native loop when it is installed; it accepts
+    array('q') buffers directly. amount must fit in a signed 64-bit int, since
+    numba types anything larger as unsigned and refuses to convert it.
+    """
+    i = 0
+    n = len(remaining)
+    while amount > 0 and i < n:
+        diff = min(amount, remaining[i])
+        remaining[i] -= diff
+        amount -= diff
+        if remaining[i] == 0:
+            i += 1
+    return i
+
+# compile the kernel (or load it from numba's on-disk cache) at import time
+# rather than on the request path of the first /spend
+_consume(array('q'), 0)
 
 class transaction_logic:
     """
@@ -16,8 +50,13 @@ class transaction_logic:
     """
 
     # convenience constants
-    _datetime_format = "%Y-%m-%dT%H:%M:%SZ"
-    _req_fields = ( "payer" , "points" , "timestamp" )
+    # points and timestamps are stored in signed 64-bit arrays
+    _points_min, _points_max = -2**63, 2**63 - 1
+    _not_a_dict_error = "Each transaction object must be a dictionary containing keys 'payer' (str), 'points' (int) and 'timestamp' (str). Other keys will not cause problems but will be ignored"
+    _epoch = datetime(1970, 1, 1)
+    # exact layout of a valid timestamp, checked before handing it to
+    # fromisoformat (which also accepts week dates, UTC offsets etc.)
+    _timestamp_layout = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z")
 
     def __init__(self, filename = None):
         """Loads into memory a transaction list from a JSON file with supplied
@@ -26,24 +65,59 @@ class transaction_logic:
         functionality elsewhere to persist changes to the transaction list
         as this is not required per the assignment, but I did create
         transactions.json to provide dummy transactions that would
-        facilitate testing."""
-        self.data = None
+        facilitate testing.
 
-        if filename is None:
-            self.data = {}
-        else:
+        Running per-payer point totals are kept in self._balances alongside
+        the transaction list, so balances never have to be recomputed by
+        scanning it. They are accumulated once here for any loaded
+        transactions and then updated as each new transaction is committed.
+        The total across all payers is kept the same way in self._total.
+
+        The transaction list is stored column-wise as three parallel
+        sequences (self.payers, self.points and self.timestamps) rather than
+        as a list of dicts, so aggregations walk flat arrays instead of doing
+        a dict lookup per field per row. Row i of the list is made up of
+        element i of each column. Timestamps are parsed once on the way in
+        and stored as int Unix epoch seconds, which compare and sort much
+        faster than the original strings.
+
+        The transaction list is kept sorted by timestamp: loaded transactions
+        are sorted once here, and new ones are inserted in order, so spending
+        never has to sort the full history."""
+        transactions = []
+        self._balances = defaultdict(int)
+
+        if filename is not None:
             with open(os.getcwd() + os.sep + filename, 'r') as f:
-                self.data = json.load(f)["transactions"]
+                transactions = json.load(f)["transactions"]
+            transactions.sort(key = itemgetter("timestamp"))
+
+        # payer names repeat across many transactions, so they are interned to
+        # keep a single copy of each and make comparisons and hashing cheap
+        self.payers = [ sys.intern(t["payer"]) for t in transactions ]
+        self.points = array('q', ( t["points"] for t in transactions ))
+        self.timestamps = array('q', ( transaction_logic._epoch_seconds(
+            datetime.fromisoformat(t["timestamp"][:-1])) for t in transactions ))
+
+        for p, pts in zip(self.payers, self.points):
+            self._balances[p] += pts
+        self._total = sum(self.points)
+
+    @staticmethod
+    def _epoch_seconds(timestamp):
+        """Converts a parsed (naive, UTC) timestamp to int Unix epoch seconds."""
+        delta = timestamp - transaction_logic._epoch
+        return delta.days * 86400 + delta.seconds
 
     def payer_balances(self):
-        """This function returns a dict of all unique payers in self.data
-        (the stored transaction list) along with their current point totals
+        """This function returns a dict of all unique payers in the stored
+        transaction list along with their current point totals
         (which may be zero).
-        Can be called either directly by the API or transaction_logic methods."""
+        Can be called either directly by the API or transaction_logic methods.
+        Reads the running totals kept in self._balances and returns a copy, so
+        callers cannot modify them."""
 
-        payers = set( ( t["payer"] for t in self.data ) )
-        return { p : sum( ( t["points"] for t in self.data \
-            if t["payer"] == p ) ) for p in payers }
+        return dict(self._balances)
 
     def add_points(self, transaction):
         """Adds a transaction to the stored list via a wrapped call to 
@@ -53,13 +127,15 @@ class transaction_logic:
         to ._new_transaction().
         
         Returns nothing."""
-        try:
-            assert transaction['points'] > 0
-            self._new_transaction(transaction)
-        except KeyError:
+        if not isinstance(transaction, dict):
+            raise ValueError(transaction_logic._not_a_dict_error)
+        if 'points' not in transaction:
             raise ValueError("Field 'points' (int) is missing")
-        except AssertionError:
+        points = transaction['points']
+        # bool is a subclass of int, so check the exact type to reject it
+        if not ( type(points) is int and points > 0 ):
             raise ValueError("Invalid value for field 'points', must be positive int")
+        self._new_transaction(transaction)
         
     def _new_transaction(self, to_add):
         """
@@ -74,53 +150,75 @@ class transaction_logic:
         ._validate_transaction()) if a malformed transaction object is passed
         to it.
         """
-        self._validate_transaction(to_add)
+        parsed = self._validate_transaction(to_add)
         # Input is valid if we've gotten this far
-        self.data.append({ k:to_add[k] for k in transaction_logic._req_fields})
+        payer = sys.intern(to_add["payer"])
+        points = to_add["points"]
+        timestamp = transaction_logic._epoch_seconds(parsed)
+        i = bisect.bisect_right(self.timestamps, timestamp)
+        self.points.insert(i, points)
+        self.payers.insert(i, payer)
+        self.timestamps.insert(i, timestamp)
+        self._balances[payer] += points
+        self._total += points
 
     def _validate_transaction(self, transaction):
         """
         Validates a single transaction object for use by ._new_transaction(). Separated
         from that function to reduce the frequency of write transactions. See error
-        messages in the try block for how a transaction can be invalid. Assertions
-        make the conditions easier to read and the use of the errormsg variable simplifies
-        the exception handling. Not meant to be called directly; only ._new_transaction()
-        should ever call this.
+        messages below for how a transaction can be invalid. Each condition is checked
+        with an explicit if/raise rather than an assertion, so validation still happens
+        when Python runs with -O. Not meant to be called directly; only ._new_transaction()
+        should ever call this. Returns the parsed timestamp as a datetime so it does not
+        have to be parsed again when the transaction is stored.
         """
-        errormsg = None
+        now = datetime.now()
+        # Passed object is a dict
+        if not isinstance(transaction, dict):
+            raise ValueError(transaction_logic._not_a_dict_error)
+        # Required data all present
+        if not ("payer" in transaction and "points" in transaction \
+                and "timestamp" in transaction):
+            raise ValueError("One of the required fields (payer, points, timestamp) is missing")
+        payer = transaction["payer"]
+        points = transaction["points"]
+        timestamp = transaction["timestamp"]
+        # Correct types
+        if not isinstance(payer, str):
+            raise ValueError("Type of field 'payer' is invalid, must be string")
+        if not isinstance(timestamp, str):
+            raise ValueError("Type of field 'timestamp' is invalid, must be string")
+        # bool is a subclass of int, so check the exact type to keep rejecting it
+        if not ( type(points) is int and points != 0 and \
+                transaction_logic._points_min <= points <= transaction_logic._points_max ):
+            raise ValueError("Type or value of field 'points' is invalid, must be nonzero int")
+        # Time format is correct and transaction does not take place in future
+        # (fromisoformat is much faster than strptime but more lenient, so
+        # the exact layout of the string is checked first, then the trailing
+        # Z is stripped before parsing)
+        timestamp_format_error = "Timestamp format incorrect, use YYYY-MM-DDTHH:MM:SSZ"
+        if transaction_logic._timestamp_layout.fullmatch(timestamp) is None:
+            raise ValueError(timestamp_format_error)
         try:
-            # Required data all present
-            errormsg = "One of the required fields (payer, points, timestamp) is missing"
-            assert all(x in transaction for x in transaction_logic._req_fields)
-            # Correct types
-            errormsg = "Type of field 'payer' is invalid, must be string"
-            assert type(transaction["payer"]).__name__ == "str"
-            errormsg = "Type of field 'timestamp' is invalid, must be string"
-            assert type(transaction["timestamp"]).__name__ == "str"
-            errormsg = "Type or value of field 'points' is invalid, must be nonzero int"
-            assert type(transaction["points"]).__name__ == "int" and transaction["points"] != 0
-            # Time format is correct and transaction does not take place in future
-            errormsg = "Transaction timestamp is in the future"
-            assert datetime.strptime(transaction["timestamp"], transaction_logic._datetime_format) \
-                <= datetime.now()
-            # Transaction won't take overall balance negative
-            balances = self.payer_balances()
-            errormsg = "Transaction exceeds total available point balance"
-            assert transaction["points"] + sum(b for b in balances.values()) >= 0
-            # Transaction won't take payer balance negative
-            # Transaction doesn't try to spend from a first-time payer
-            errormsg = "Transaction exceeds available points to spend for this payer"
-            assert transaction["points"] + ( 0 if transaction["payer"] not in balances \
-                else balances[transaction["payer"]] ) >= 0
-        except AssertionError:
-            # raised by most possible failures
-            raise ValueError(errormsg)
-        except TypeError:
-            # raised if passed object is not a dict, when we try to check the types of fields
-            raise ValueError("Each transaction object must be a dictionary containing keys 'payer' (str), 'points' (int) and 'timestamp' (str). Other keys will not cause problems but will be ignored")
+            parsed = datetime.fromisoformat(timestamp[:-1])
         except ValueError:
-            # raised if the timestamp format is incorrect when we try to parse it
-            raise ValueError("Timestamp format incorrect, use YYYY-MM-DDTHH:MM:SSZ")
+            raise ValueError(timestamp_format_error)
+        if parsed > now:
+            raise ValueError("Transaction timestamp is in the future")
+        # Transaction won't take overall balance negative
+        if points + self._total < 0:
+            raise ValueError("Transaction exceeds total available point balance")
+        # Transaction won't take payer balance negative
+        # Transaction doesn't try to spend from a first-time payer
+        # (.get() rather than indexing so no entry is created for a new payer)
+        balance = points + self._balances.get(payer, 0)
+        if balance < 0:
+            raise ValueError("Transaction exceeds available points to spend for this payer")
+        # Transaction won't take payer balance past what a single stored
+        # transaction can hold, so spending the whole balance is always possible
+        if balance > transaction_logic._points_max:
+            raise ValueError("Transaction exceeds maximum point balance for this payer")
+        return parsed
 
     def spend_points(self, amount):
         """
@@ -134,12 +232,16 @@ class transaction_logic:
         the requested amount has been spent, never allowing any payer's balance
         to go negative.
 
-        Transactions are split up by payer in order to identify the oldest
-        available points for each payer, then merged and sorted again by age
+        Transactions (already stored in timestamp order) are split up by payer
+        in a single pass in order to identify the oldest available points for
+        each payer, then merged and sorted again by age
         such that only available points are spent, in the order they were
         added, generating a dict indicating points spent by each payer
         with a positive balance at the time the transaction is requested.
 
+        The oldest-first consumption of points in both steps is done by
+        _consume().
+
         After determining how much to spend for each payer, ._new_transaction()
         is called with a dict for each payer whose points were spent indicating
         the amount they spent and the time the spend was requested.
@@ -147,80 +249,75 @@ class transaction_logic:
         After all required transactions have been committed, a dict indicating
         the points spent by each payer is returned.
         """
-        balances = self.payer_balances()
-        # Input validation - verify possibility of spend across all payers
-        errormsg = None
-        try:
-            errormsg = "Requested spend exceeds available point balance"
-            assert amount <= sum( balances.values() )
-            errormsg = "Must spend a positive number of points"
-            assert amount > 0
-        except AssertionError:
-            raise ValueError( errormsg )
+        balances = self._balances
+        # Input validation - amount is an int (bool is a subclass of int, so
+        # check the exact type to reject it) and the spend is possible
+        # across all payers
+        if type(amount) is not int:
+            raise ValueError( "Type of field 'points' is invalid, must be positive int" )
+        if amount > self._total:
+            raise ValueError( "Requested spend exceeds available point balance" )
+        if amount <= 0:
+            raise ValueError( "Must spend a positive number of points" )
+        if amount > transaction_logic._points_max:
+            raise ValueError( "Must spend at most %d points at a time"
+                % transaction_logic._points_max )
         # Spend according to rules
 
     # Which unspent points are oldest for each payer?
     # (have to separate by payer because transactions are by payer, and
     # without separating them a payer's balance might go negative )
         payers = [ k for k in balances.keys() if balances[k] > 0 ]
-        print(payers)
         live_points = []
 
+        # the stored list is in timestamp order, so each payer's history is too
+        per_payer = defaultdict(list)
+        for p, pts, ts in zip(self.payers, self.points, self.timestamps):
+            per_payer[p].append((ts, pts))
+
         for p in payers:
-            print(p)
-            history = sorted(
-                [ t for t in self.data if t["payer"] == p ] ,
-                key = lambda x: x["timestamp"]
+            history = per_payer[p]
+            credit_times = [ ts for ts, pts in history if pts > 0 ]
+            remaining = array('q', ( pts for ts, pts in history if pts > 0 ))
+            # debits always spend a payer's oldest points first, so applying
+            # them one at a time is the same as applying their total at once.
+            # The total is applied in pieces that fit _consume()'s int64
+            # argument, as a payer's debits over time can add up to more.
+            debited = -sum( pts for ts, pts in history if pts < 0 )
+            i = 0
+            while debited > 0:
+                piece = min(debited, transaction_logic._points_max)
+                i = _consume(remaining, piece)
+                debited -= piece
+            # ( timestamp, unspent points, payer ) for each live credit
+            live_points.extend(
+                ( credit_times[j], remaining[j], p ) for j in range(i, len(remaining))
             )
-            debits = [ t for t in history if t["points"] < 0 ]
-            credits = [ [t, t["points"]] for t in history if t["points"] > 0 ]
-            
-            i = None
-            for d in debits:
-                print(d)
-                rem = abs(d["points"])
-                if i is None:
-                    i = 0
-                while rem > 0:
-                    diff = min(rem, credits[i][1])
-                    credits[i][1] -= diff
-                    rem -= diff
-                    if credits[i][1] == 0:
-                        i += 1
-            
-            live_points += credits[i:]
 
         # which unspent points are oldest overall? Have to sort by timestamp
         # again because separating by payer messed up our original order
 
-        live_points = sorted(
-            live_points ,
-            key = lambda x: x[0]["timestamp"]
-        )
+        live_points.sort(key = itemgetter(0))
 
-        i = 0
+        remaining = array('q', ( pts for ts, pts, p in live_points ))
+        i = _consume(remaining, amount)
         spends = {}
         for p in payers:
             spends[p] = 0
-        while amount > 0:
-            diff = min(amount, live_points[i][1])
-            live_points[i][1] -= diff
-            amount -= diff
-            spends[live_points[i][0]["payer"]] -= diff
-            if live_points[i][1] == 0:
-                i += 1
-
-        # now commit transactions based on what we're spending
+        # credits before i were spent entirely; the one at i may be partly spent
+        for j in range(min(i + 1, len(live_points))):
+            spends[live_points[j][2]] -= live_points[j][1] - remaining[j]
+
+        # now commit transactions based on what we're spending, all stamped
+        # with the same time (formatted once, in YYYY-MM-DDTHH:MM:SSZ form)
+        timestamp = datetime.now().isoformat(timespec = "seconds") + "Z"
         for k,v in spends.items():
             if v != 0:
                 self._new_transaction(
                     {
                         "payer" : k,
                         "points": v ,
-                        "timestamp": datetime.strftime(
-                            datetime.now() ,
-                            transaction_logic._datetime_format
-                        )
+                        "timestamp": timestamp
                     }
                 )
         